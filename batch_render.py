@@ -0,0 +1,216 @@
+"""
+Пакетная генерация видео для целого курса без Redis и Celery.
+
+Пример запуска:
+    python batch_render.py course.json --output-dir out --workers 4
+
+Манифест — JSON-список уроков:
+    [
+        {"id": "lesson_01", "json": "l1/timings.json", "presentation": "l1/slides.pdf", "video": "l1/speaker.mp4"},
+        {"id": "lesson_02", "json": "...", "presentation": "...", "video": "...", "renditions": ["720p"], "hls": true,
+         "encoding_profile": "screen", "target_size_mb": 50}
+    ]
+Относительные пути считаются от папки манифеста. Уже готовые уроки при повторном запуске пропускаются
+(состояние хранится в <output-dir>/batch_state.json), в конце печатается и сохраняется отчет.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ffmpeg_runner import install_cancel_handler, cancellable_job
+from video_processor import process_video_with_presentation, validate_renditions, validate_encoding_profile
+
+STATE_FILENAME = 'batch_state.json'
+REPORT_FILENAME = 'batch_report.json'
+
+
+def load_manifest(manifest_path):
+    """Читает манифест и приводит уроки к единому виду с абсолютными путями."""
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        lessons = json.load(f)
+    if not isinstance(lessons, list):
+        raise ValueError("Манифест должен быть JSON-списком уроков")
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    result = []
+    seen_ids = set()
+    for i, lesson in enumerate(lessons):
+        lesson_id = str(lesson.get('id') or f'lesson_{i + 1:03d}')
+        if lesson_id in seen_ids:
+            raise ValueError(f"Повторяющийся id урока в манифесте: {lesson_id}")
+        seen_ids.add(lesson_id)
+        for key in ('json', 'presentation', 'video'):
+            if key not in lesson:
+                raise ValueError(f"Урок {lesson_id}: не указано поле '{key}'")
+        result.append({
+            'id': lesson_id,
+            'json': os.path.join(base_dir, lesson['json']),
+            'presentation': os.path.join(base_dir, lesson['presentation']),
+            'video': os.path.join(base_dir, lesson['video']),
+            'renditions': validate_renditions(lesson.get('renditions')),
+            'hls': bool(lesson.get('hls', False)),
+            'encoding_profile': validate_encoding_profile(lesson.get('encoding_profile')),
+            'target_bitrate': lesson.get('target_bitrate'),
+            'target_size_mb': lesson.get('target_size_mb'),
+        })
+    return result
+
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state_path, state):
+    # Пишем через временный файл, чтобы прерванный запуск не оставил битое состояние
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def lesson_outputs(lesson, output_dir):
+    """Пути результатов урока: основное видео, варианты качества, папка HLS и папка миниатюр."""
+    output_path = os.path.join(output_dir, f"{lesson['id']}.mp4")
+    renditions = {name: os.path.join(output_dir, f"{lesson['id']}_{name}.mp4") for name in lesson['renditions']}
+    hls_dir = os.path.join(output_dir, f"{lesson['id']}_hls") if lesson['hls'] else None
+    thumbnails_dir = os.path.join(output_dir, f"{lesson['id']}_thumbnails")
+    return output_path, renditions, hls_dir, thumbnails_dir
+
+
+def init_worker(worker_pids):
+    """
+    Инициализатор процессов пула: ffmpeg запускается в отдельной сессии и сам сигналов не получает,
+    поэтому при остановке batch_render (SIGTERM или Ctrl+C) процесс пула должен погасить его сам.
+    PID процесса сообщается через очередь worker_pids, чтобы главный процесс мог послать ему сигнал.
+    """
+    install_cancel_handler(signal.SIGTERM)
+    install_cancel_handler(signal.SIGINT)
+    worker_pids.put(os.getpid())
+
+
+def stop_workers(worker_pids):
+    """Шлет SIGTERM процессам пула: каждый останавливает свои ffmpeg и удаляет временные файлы."""
+    pids = set()
+    while not worker_pids.empty():
+        pids.add(worker_pids.get())
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def render_lesson(lesson, output_dir):
+    """Обрабатывает один урок в процессе пула. Возвращает словарь с результатом для отчета."""
+    output_path, renditions, hls_dir, thumbnails_dir = lesson_outputs(lesson, output_dir)
+    started = time.monotonic()
+    try:
+        with cancellable_job():
+            process_video_with_presentation(
+                json_path=lesson['json'],
+                presentation_path=lesson['presentation'],
+                video_path=lesson['video'],
+                output_path=output_path,
+                renditions=renditions,
+                hls_dir=hls_dir,
+                encoding_profile=lesson['encoding_profile'],
+                target_bitrate=lesson['target_bitrate'],
+                target_size_mb=lesson['target_size_mb'],
+                thumbnails_dir=thumbnails_dir
+            )
+    except Exception as e:
+        traceback.print_exc()
+        return {'id': lesson['id'], 'status': 'FAILURE', 'error': str(e),
+                'elapsed': round(time.monotonic() - started, 1)}
+    return {'id': lesson['id'], 'status': 'SUCCESS', 'output': output_path,
+            'renditions': renditions, 'hls_dir': hls_dir, 'thumbnails_dir': thumbnails_dir,
+            'elapsed': round(time.monotonic() - started, 1)}
+
+
+def is_done(lesson, state, output_dir):
+    """Урок считается готовым, если он отмечен в состоянии и его основной файл на месте."""
+    output_path = lesson_outputs(lesson, output_dir)[0]
+    return state.get(lesson['id'], {}).get('status') == 'SUCCESS' and os.path.exists(output_path)
+
+
+def run_batch(manifest_path, output_dir, workers):
+    lessons = load_manifest(manifest_path)
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, STATE_FILENAME)
+    state = load_state(state_path)
+
+    pending = [lesson for lesson in lessons if not is_done(lesson, state, output_dir)]
+    skipped = len(lessons) - len(pending)
+    print(f"Уроков в манифесте: {len(lessons)}, уже готово: {skipped}, к обработке: {len(pending)}")
+
+    started = time.monotonic()
+    worker_pids = multiprocessing.SimpleQueue()
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(worker_pids,))
+    try:
+        futures = {pool.submit(render_lesson, lesson, output_dir): lesson for lesson in pending}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # Процесс пула погиб (например, убит OOM killer) — урок и остальные незавершенные
+                # уроки отмечаются как неудачные, отчет все равно сохраняется
+                result = {'id': futures[future]['id'], 'status': 'FAILURE',
+                          'error': f"Процесс обработки урока завершился аварийно: {e!r}", 'elapsed': None}
+            state[result['id']] = result
+            save_state(state_path, state)
+            elapsed = f" ({result['elapsed']} с)" if result['elapsed'] is not None else ''
+            print(f"  [{result['status']}] {result['id']}{elapsed}")
+    except KeyboardInterrupt:
+        print("Обработка прервана, останавливаю ffmpeg...")
+        stop_workers(worker_pids)
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    report = {
+        'manifest': os.path.abspath(manifest_path),
+        'total': len(lessons),
+        'skipped': skipped,
+        'succeeded': sum(1 for lesson in lessons if state.get(lesson['id'], {}).get('status') == 'SUCCESS'),
+        'failed': [lesson['id'] for lesson in lessons if state.get(lesson['id'], {}).get('status') == 'FAILURE'],
+        'elapsed': round(time.monotonic() - started, 1),
+        'lessons': [state.get(lesson['id'], {'id': lesson['id'], 'status': 'PENDING'}) for lesson in lessons],
+    }
+    with open(os.path.join(output_dir, REPORT_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"Готово: {report['succeeded']}/{report['total']}, ошибок: {len(report['failed'])}, "
+          f"время: {report['elapsed']} с")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетная генерация видео уроков по манифесту.")
+    parser.add_argument('manifest', help="JSON-файл со списком уроков")
+    parser.add_argument('--output-dir', default='batch_output', help="Папка для готовых видео, состояния и отчета")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Сколько уроков обрабатывать параллельно")
+    args = parser.parse_args(argv)
+
+    # SIGTERM обрабатывается так же, как Ctrl+C: процессы пула останавливают свои ffmpeg
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    report = run_batch(args.manifest, args.output_dir, args.workers)
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,12 @@
 import os
 import shutil
+import tempfile
 from celery import Celery
-from video_processor import process_video_with_presentation # Импортируем вашу функцию
+from celery.exceptions import Ignore
+from celery.signals import worker_init, worker_process_init, task_revoked
+from ffmpeg_runner import install_cancel_handler, cancellable_job, JobCancelled
+from storage import get_storage
+from video_settings import validate_renditions, validate_encoding_profile, HLS_PLAYLIST_NAME
 
 # Настраиваем Celery. 'tasks' - это просто имя.
 # broker - это наш Redis, куда сервер будет класть задачи.
@@ -22,52 +27,165 @@ celery_app.conf.update(
 )
 
 UPLOADS_DIR = "uploads" # Убедитесь, что эта папка существует
+# Папка для временных файлов задачи на этом воркере. Входные файлы и результаты хранятся в storage.
+WORK_DIR = os.getenv('WORK_DIR', UPLOADS_DIR)
 
-def cleanup_files(paths: list[str]):
-    """Функция для удаления списка файлов."""
-    for path in paths:
-        if os.path.exists(path):
-            try:
-                os.remove(path)
-            except OSError as e:
-                print(f"Error removing file {path}: {e}")
+
+@worker_init.connect
+def prewarm_worker(**kwargs):
+    """
+    Загружает тяжелые модули обработки видео (pdf2image, PyPDF2) один раз в главном процессе воркера,
+    до запуска пула: дочерние процессы получают их уже загруженными, и первая задача не ждет импорта.
+    Веб-сервис импортирует этот модуль только ради постановки задач и эти модули не загружает.
+    """
+    import video_processor  # noqa: F401
+
+
+@worker_process_init.connect
+def setup_cancel_handler(**kwargs):
+    """Отмена задачи (revoke с terminate=True) должна гасить запущенные ffmpeg, а не только сам процесс воркера."""
+    install_cancel_handler()
+
+def cleanup_keys(storage, keys: list[str]):
+    """Функция для удаления списка файлов из хранилища."""
+    for key in keys:
+        try:
+            storage.delete(key)
+        except Exception as e:
+            print(f"Error removing {key} from storage: {e}")
 
 @celery_app.task(bind=True)
-def create_video_task(self, json_path: str, pres_path: str, video_path: str):
+def create_video_task(self, json_key: str, pres_key: str, video_key: str, renditions: list[str] | None = None,
+                      hls: bool = False, encoding_profile: str | None = None, target_bitrate: int | None = None,
+                      target_size_mb: float | None = None):
     """
     Celery-задача для асинхронной генерации видео.
     `bind=True` позволяет получить доступ к объекту задачи `self`.
+    json_key, pres_key, video_key — ключи входных файлов в хранилище (см. storage.get_storage).
+    Воркер скачивает их во временную папку, а готовые файлы публикует обратно в хранилище,
+    поэтому может работать на любой машине.
+    renditions — список дополнительных вариантов качества (например, ['720p', '480p']),
+    которые собираются в том же проходе, что и основное видео 1080p.
+    hls — дополнительно записать HLS-версию (сегменты + плейлист) с префиксом hls_<task_id>/.
+    encoding_profile, target_bitrate, target_size_mb — профиль кодирования и необязательный
+    целевой битрейт (кбит/с) или размер файла (МБ), см. video_settings.ENCODING_PROFILES.
+    В итоговый MP4 записываются главы по слайдам, а спрайт миниатюр и WebVTT-индекс к нему
+    публикуются с префиксом thumbnails_<task_id>/.
+    """
+    # Импорт здесь, а не на уровне модуля: веб-сервису, который ставит задачи, он не нужен.
+    # В воркере модуль уже загружен в prewarm_worker.
+    from video_processor import process_video_with_presentation
+
+    storage = get_storage()
+    # Ключи уже опубликованных результатов: при ошибке их нужно удалить из хранилища
+    published_keys = []
+    scratch_dir = None
+
+    # Отменяемой сигналом считается вся задача, включая скачивание входных файлов и публикацию результатов:
+    # иначе отмена в эти моменты завершит процесс воркера без очистки
+    with cancellable_job():
+        try:
+            # Проверка параметров внутри try: при ошибке входные файлы все равно удаляются из хранилища
+            output_filename = f"processed_video_{self.request.id}.mp4"
+            rendition_files = {
+                name: f"processed_video_{self.request.id}_{name}.mp4" for name in validate_renditions(renditions)
+            }
+            encoding_profile = validate_encoding_profile(encoding_profile)
+            hls_prefix = f"hls_{self.request.id}" if hls else None
+            thumbnails_prefix = f"thumbnails_{self.request.id}"
+
+            os.makedirs(WORK_DIR, exist_ok=True)
+            scratch_dir = tempfile.mkdtemp(prefix=f"task_{self.request.id}_", dir=WORK_DIR)
+            output_path = os.path.join(scratch_dir, output_filename)
+            rendition_paths = {name: os.path.join(scratch_dir, filename) for name, filename in rendition_files.items()}
+            hls_dir = os.path.join(scratch_dir, 'hls') if hls else None
+            thumbnails_dir = os.path.join(scratch_dir, 'thumbnails')
+
+            # Здесь мы можем передавать прогресс выполнения
+            self.update_state(state='PROGRESS', meta={'status': 'Начинаю обработку...'})
+
+            json_path = storage.fetch(json_key, scratch_dir)
+            pres_path = storage.fetch(pres_key, scratch_dir)
+            video_path = storage.fetch(video_key, scratch_dir)
+
+            # Вызываем вашу основную функцию обработки
+            process_video_with_presentation(
+                json_path=json_path,
+                presentation_path=pres_path,
+                video_path=video_path,
+                output_path=output_path,
+                renditions=rendition_paths,
+                hls_dir=hls_dir,
+                encoding_profile=encoding_profile,
+                target_bitrate=target_bitrate,
+                target_size_mb=target_size_mb,
+                thumbnails_dir=thumbnails_dir
+            )
+
+            self.update_state(state='PROGRESS', meta={'status': 'Сохраняю результат...'})
+            storage.publish(output_path, output_filename)
+            published_keys.append(output_filename)
+            for name, filename in rendition_files.items():
+                storage.publish(rendition_paths[name], filename)
+                published_keys.append(filename)
+            if hls_dir:
+                # Плейлист публикуем последним, чтобы он не ссылался на еще не загруженные сегменты
+                names = sorted(os.listdir(hls_dir), key=lambda name: name == HLS_PLAYLIST_NAME)
+                for name in names:
+                    key = f"{hls_prefix}/{name}"
+                    storage.publish(os.path.join(hls_dir, name), key)
+                    published_keys.append(key)
+            for name in os.listdir(thumbnails_dir):
+                key = f"{thumbnails_prefix}/{name}"
+                storage.publish(os.path.join(thumbnails_dir, name), key)
+                published_keys.append(key)
+
+            # Если все успешно, возвращаем ключ готового файла в хранилище
+            return {
+                'status': 'SUCCESS',
+                'result_key': output_filename,
+                'result_filename': output_filename,
+                'renditions': {
+                    name: {'result_key': filename, 'result_filename': filename}
+                    for name, filename in rendition_files.items()
+                },
+                'hls_prefix': hls_prefix,
+                'thumbnails_prefix': thumbnails_prefix,
+            }
+
+        except JobCancelled:
+            print(f"Task {self.request.id} cancelled")
+            cleanup_keys(storage, published_keys)
+            # Без этого Celery запишет FAILURE поверх REVOKED, который сохранил главный процесс воркера
+            self.backend.mark_as_revoked(self.request.id, 'Задача отменена', request=self.request)
+            raise Ignore()
+        except Exception as e:
+            # В случае ошибки, Celery автоматически пометит задачу как FAILED
+            # и сохранит исключение.
+            print(f"Task failed: {e}")
+            # Подчищаем за собой в случае ошибки
+            cleanup_keys(storage, published_keys)
+            # Перевыбрасываем исключение, чтобы Celery корректно обработал сбой
+            raise e
+        finally:
+            # ВАЖНО: Не удаляем результат, если задача выполнена успешно!
+            # Удаляем только исходники и временную папку воркера.
+            cleanup_keys(storage, [json_key, pres_key, video_key])
+            if scratch_dir:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+@task_revoked.connect
+def cleanup_revoked_inputs(sender=None, request=None, terminated=False, **kwargs):
+    """
+    Задача, отмененная до начала выполнения (еще в очереди), не запускается вовсе,
+    поэтому ее входные файлы удаляются здесь, в главном процессе воркера.
+    Выполнявшаяся задача (terminated=True) удаляет их сама при обработке JobCancelled.
     """
-    output_filename = f"processed_video_{self.request.id}.mp4"
-    output_path = os.path.join(UPLOADS_DIR, output_filename)
-
-    # Список всех временных файлов, которые нужно будет удалить в конце
-    temp_files_to_clean = [json_path, pres_path, video_path, output_path]
-
-    try:
-        # Здесь мы можем передавать прогресс выполнения
-        self.update_state(state='PROGRESS', meta={'status': 'Начинаю обработку...'})
-
-        # Вызываем вашу основную функцию обработки
-        process_video_with_presentation(
-            json_path=json_path,
-            presentation_path=pres_path,
-            video_path=video_path,
-            output_path=output_path
-        )
-
-        # Если все успешно, возвращаем путь к готовому файлу
-        return {'status': 'SUCCESS', 'result_path': output_path, 'result_filename': output_filename}
-
-    except Exception as e:
-        # В случае ошибки, Celery автоматически пометит задачу как FAILED
-        # и сохранит исключение.
-        print(f"Task failed: {e}")
-        # Подчищаем за собой в случае ошибки
-        cleanup_files(temp_files_to_clean)
-        # Перевыбрасываем исключение, чтобы Celery корректно обработал сбой
-        raise e
-    finally:
-        # ВАЖНО: Не удаляем output_path, если задача выполнена успешно!
-        # Удаляем только исходники.
-        cleanup_files([json_path, pres_path, video_path])
\ No newline at end of file
+    if terminated or sender is None or sender.name != create_video_task.name or request is None:
+        return
+    args = list(request.args or [])
+    task_kwargs = request.kwargs or {}
+    keys = [args[i] if i < len(args) else task_kwargs.get(name)
+            for i, name in enumerate(('json_key', 'pres_key', 'video_key'))]
+    cleanup_keys(get_storage(), [key for key in keys if key])
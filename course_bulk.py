@@ -0,0 +1,199 @@
+# course_bulk.py
+import json
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, Iterator, List
+
+from generator import PresentationGenerator, prewarm
+
+# Сколько презентаций генерируется параллельно и сколько готовых может ждать записи в архив.
+# Вместе они ограничивают потребление памяти при выгрузке большого курса.
+BULK_WORKERS = int(os.getenv('BULK_WORKERS', str(os.cpu_count() or 1)))
+BULK_MAX_IN_FLIGHT = BULK_WORKERS * 2
+
+# Один пул процессов на весь веб-сервис, общий для всех запросов: сколько бы выгрузок ни шло одновременно,
+# презентации генерируют не больше BULK_WORKERS процессов. Процессы запускаются через spawn,
+# а не fork: fork из многопоточного процесса uvicorn может оставить в дочернем процессе захваченные блокировки.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def start_bulk_pool() -> ProcessPoolExecutor:
+    """Создает общий пул (вызывается при старте веб-сервиса) или возвращает уже созданный."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=BULK_WORKERS, initializer=prewarm,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_bulk_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _discard_broken_pool(pool: ProcessPoolExecutor) -> None:
+    """Пул, в котором погиб процесс, больше не принимает задачи: следующий запрос создаст новый."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def course_to_presentation_data(course: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Преобразует описание курса (course_title, slides с content/bullets/lists/key_points/images)
+    в формат, который понимает PresentationGenerator.
+
+    Текст, пункты списков и картинка раскладываются по частям слайда: один тип контента — center_part,
+    два — left_part и right_part. PresentationGenerator допускает не больше двух частей,
+    поэтому третий тип контента (картинка) в этом случае не попадает на слайд.
+    """
+    if "slides" not in course:
+        raise KeyError("Ключ 'slides' не найден в описании курса.")
+
+    slides = []
+    for slide in course["slides"]:
+        parts = []
+        text = "\n".join(slide.get("content") or [])
+        if text:
+            parts.append({"content": text})
+        points = [*(slide.get("bullets") or []), *(slide.get("lists") or []), *(slide.get("key_points") or [])]
+        if points:
+            parts.append({"bullet_points": points})
+        images = slide.get("images") or []
+        if images:
+            parts.append({"image": images[0]})
+
+        slide_data: Dict[str, Any] = {"title": slide.get("title", " ")}
+        if len(parts) == 1:
+            slide_data["center_part"] = parts[0]
+        elif len(parts) > 1:
+            slide_data["left_part"], slide_data["right_part"] = parts[0], parts[1]
+        slides.append(slide_data)
+
+    return {"slides": slides}
+
+
+def parse_courses(body: bytes) -> List[Dict[str, Any]]:
+    """
+    Разбирает тело запроса: либо один JSON-документ (курс, список курсов или {"courses": [...]}),
+    либо NDJSON — по одному курсу в строке.
+    """
+    text = body.decode("utf-8")
+    try:
+        document = json.loads(text)
+    except json.JSONDecodeError:
+        document = None
+
+    if document is None:
+        try:
+            courses = [json.loads(line) for line in text.splitlines() if line.strip()]
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Не удалось разобрать NDJSON: {e}")
+    elif isinstance(document, list):
+        courses = document
+    elif isinstance(document, dict) and "courses" in document:
+        courses = document["courses"]
+    elif isinstance(document, dict):
+        courses = [document]
+    else:
+        raise ValueError("Ожидается курс, список курсов или NDJSON")
+
+    # Проверяем все курсы до начала выгрузки: после первого отданного куска ответа вернуть 400 уже нельзя
+    if not isinstance(courses, list):
+        raise ValueError("Ключ 'courses' должен содержать список курсов")
+    for i, course in enumerate(courses):
+        if not isinstance(course, dict):
+            raise ValueError(f"Курс {i + 1} должен быть JSON-объектом")
+    return courses
+
+
+def _deck_filename(index: int, course: Dict[str, Any]) -> str:
+    title = re.sub(r"[^\w\-]+", "_", str(course.get("course_title") or "presentation")).strip("_")
+    return f"{index + 1:03d}_{title[:80] or 'presentation'}.pptx"
+
+
+def _build_deck(course: Dict[str, Any]) -> bytes:
+    """Выполняется в процессе пула: генерирует одну презентацию и возвращает ее байты."""
+    return PresentationGenerator(course_to_presentation_data(course)).generate().getvalue()
+
+
+class _ChunkBuffer:
+    """Несжимаемый поток для zipfile: накапливает записанные байты, пока их не заберет генератор ответа."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_presentations_zip(courses: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    """
+    Генерирует презентации параллельно и отдает ZIP-архив кусками по мере готовности каждой из них.
+    В памяти одновременно держится не больше BULK_MAX_IN_FLIGHT презентаций.
+    Ошибки отдельных курсов не прерывают выгрузку, а собираются в errors.json в конце архива.
+    """
+    buffer = _ChunkBuffer()
+    errors = []
+    pool = start_bulk_pool()
+    pending = {}
+    try:
+        with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+            course_iter = enumerate(courses)
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < BULK_MAX_IN_FLIGHT:
+                    try:
+                        index, course = next(course_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[pool.submit(_build_deck, course)] = (index, course)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, course = pending.pop(future)
+                    try:
+                        zf.writestr(_deck_filename(index, course), future.result())
+                    except BrokenProcessPool:
+                        _discard_broken_pool(pool)
+                        raise
+                    except Exception as e:
+                        print(f"    [ОШИБКА] Курс {index + 1}: {e}")
+                        title = course.get("course_title") if isinstance(course, dict) else None
+                        errors.append({"index": index + 1, "course_title": title, "error": str(e)})
+                    yield buffer.drain()
+
+            if errors:
+                zf.writestr("errors.json", json.dumps(errors, ensure_ascii=False, indent=2))
+        yield buffer.drain()
+    finally:
+        # Клиент отключился или произошла ошибка: снимаем только свои еще не начатые задачи, пул общий
+        for future in pending:
+            future.cancel()
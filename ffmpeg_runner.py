@@ -0,0 +1,164 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+from contextlib import contextmanager
+
+from resource_governor import FFMPEG_THREADS, cpu_budget, signals_deferred
+
+# Таймауты этапов обработки: базовое время плюс множитель на каждую секунду обрабатываемого медиа,
+# чтобы длинный слайд не упирался в тот же лимит, что и короткий. Зависший ffmpeg будет убит по истечении таймаута.
+# Оба значения для этапа переопределяются переменными окружения FFMPEG_TIMEOUT_<ЭТАП> (секунды)
+# и FFMPEG_TIMEOUT_<ЭТАП>_PER_SECOND, например FFMPEG_TIMEOUT_COMBINE=600, FFMPEG_TIMEOUT_COMBINE_PER_SECOND=60.
+# Множители с запасом учитывают медленные профили кодирования и урезанное resource_governor число потоков.
+FFMPEG_DEFAULT_TIMEOUT = (float(os.getenv('FFMPEG_DEFAULT_TIMEOUT', '900')),
+                          float(os.getenv('FFMPEG_DEFAULT_TIMEOUT_PER_SECOND', '30')))
+
+
+def _stage_timeout(stage, base, per_second):
+    prefix = f'FFMPEG_TIMEOUT_{stage.upper()}'
+    return float(os.getenv(prefix, str(base))), float(os.getenv(f'{prefix}_PER_SECOND', str(per_second)))
+
+
+FFMPEG_STAGE_TIMEOUTS = {
+    'cut': _stage_timeout('cut', 120, 10),
+    'slide': _stage_timeout('slide', 120, 5),
+    'resize': _stage_timeout('resize', 120, 10),
+    'combine': _stage_timeout('combine', 300, 40),
+    'concat': _stage_timeout('concat', 300, 2),
+    'hls': _stage_timeout('hls', 300, 2),
+}
+# Подставляется в команду вместо числа потоков: run_ffmpeg заменяет его долей бюджета из resource_governor.
+# Каждое вхождение — отдельный пул потоков ffmpeg (декодер входа, граф фильтров, кодировщик выхода).
+THREADS = '<threads>'
+
+# Сколько ждать после SIGTERM, прежде чем добивать процесс SIGKILL
+KILL_GRACE_PERIOD = 5
+
+_active_processes = set()
+# RLock: обработчик сигнала отмены выполняется в главном потоке и может прервать код, который уже держит блокировку
+_lock = threading.RLock()
+_job_active = False
+
+
+class JobCancelled(Exception):
+    """Задача была отменена пользователем, запущенные процессы ffmpeg остановлены."""
+
+
+def kill_process_tree(proc):
+    """
+    Завершает процесс вместе со всеми его потомками.
+    ffmpeg запускается в отдельной сессии (start_new_session=True), поэтому вся группа
+    процессов гасится одним killpg: сначала SIGTERM, через KILL_GRACE_PERIOD — SIGKILL.
+    """
+    if proc.poll() is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=KILL_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+def stage_timeout(stage, duration=None):
+    """Таймаут этапа stage (в секундах) для медиа длительностью duration секунд."""
+    base, per_second = FFMPEG_STAGE_TIMEOUTS.get(stage, FFMPEG_DEFAULT_TIMEOUT)
+    return base + per_second * (duration or 0)
+
+
+def run_ffmpeg(cmd, stage=None, input_data=None, duration=None):
+    """
+    Запускает ffmpeg с таймаутом этапа stage, рассчитанным по длительности обрабатываемого медиа duration
+    (см. FFMPEG_STAGE_TIMEOUTS).
+    input_data — необязательные байты, которые передаются ffmpeg через stdin (вход '-i -').
+    Ведет себя как subprocess.run(cmd, check=True): при ненулевом коде выхода выбрасывает
+    CalledProcessError, при превышении таймаута — TimeoutExpired. В обоих случаях, а также при отмене
+    задачи, процесс и его потомки гарантированно завершаются.
+    Если в команде есть THREADS, этап сначала получает бюджет процессора (см. resource_governor.cpu_budget):
+    по FFMPEG_THREADS слотов на каждый пул потоков, но не меньше одного. Выделенные слоты делятся между
+    вхождениями THREADS, так что суммарное число потоков ffmpeg не превышает бюджета.
+    """
+    timeout = stage_timeout(stage, duration)
+    pools = cmd.count(THREADS)
+    if not pools:
+        _run(cmd, stage, input_data, timeout)
+        return
+    with cpu_budget(FFMPEG_THREADS * pools, min_threads=pools) as threads:
+        shares = iter(split_threads(threads, pools))
+        _run([str(next(shares)) if arg == THREADS else arg for arg in cmd], stage, input_data, timeout)
+
+
+def split_threads(threads, pools):
+    """
+    Делит threads потоков между pools пулами, каждому не меньше одного.
+    Остаток достается последним пулам: в команде ffmpeg это кодировщики выходов, самая тяжелая часть.
+    """
+    base, extra = divmod(threads, pools)
+    return [max(1, base + (1 if i >= pools - extra else 0)) for i in range(pools)]
+
+
+def _run(cmd, stage, input_data, timeout):
+    stdin = subprocess.PIPE if input_data is not None else None
+    # Отмена между запуском и регистрацией процесса оставила бы ffmpeg сиротой
+    with signals_deferred():
+        proc = subprocess.Popen(cmd, stdin=stdin, start_new_session=True)
+        with _lock:
+            _active_processes.add(proc)
+    try:
+        proc.communicate(input=input_data, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logging.error(f"ffmpeg stage '{stage}' timed out after {timeout:g}s, killing it")
+        kill_process_tree(proc)
+        raise
+    except BaseException:
+        kill_process_tree(proc)
+        raise
+    finally:
+        with _lock:
+            _active_processes.discard(proc)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def cancel_active_processes():
+    """Завершает все процессы ffmpeg, запущенные в текущем процессе."""
+    with _lock:
+        processes = list(_active_processes)
+    for proc in processes:
+        kill_process_tree(proc)
+
+
+def _handle_cancel_signal(signum, frame):
+    if not _job_active:
+        # Сигнал пришел вне задачи (например, остановка воркера) — ведем себя как обычно
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+        return
+    logging.warning(f"Received signal {signum}, cancelling job")
+    cancel_active_processes()
+    raise JobCancelled("Задача отменена")
+
+
+def install_cancel_handler(signum=signal.SIGTERM):
+    """
+    Устанавливает обработчик сигнала отмены в процессе воркера.
+    revoke(terminate=True) шлет этот сигнал процессу, выполняющему задачу: обработчик гасит
+    ffmpeg и выбрасывает JobCancelled в коде задачи, чтобы она подчистила свои файлы.
+    """
+    signal.signal(signum, _handle_cancel_signal)
+
+
+@contextmanager
+def cancellable_job():
+    """Помечает текущую задачу как отменяемую сигналом (см. install_cancel_handler)."""
+    global _job_active
+    _job_active = True
+    try:
+        yield
+    finally:
+        _job_active = False
@@ -0,0 +1,108 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+# Кэш готовых фрагментов (склеенных слайд + спикер) между задачами.
+# Ключ фрагмента зависит только от его входных данных, поэтому при повторной отправке урока
+# перекодируются лишь изменившиеся слайды, а остальные берутся из кэша на этапе склейки.
+# По умолчанию — uploads/fragment_cache рядом с кодом приложения, независимо от текущей папки процесса
+# (в Docker это /app/uploads/fragment_cache). Кэш может лежать на другой файловой системе,
+# чем временные папки задач (WORK_DIR, --output-dir batch_render).
+FRAGMENT_CACHE_DIR = os.path.abspath(os.getenv(
+    'FRAGMENT_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads', 'fragment_cache')))
+FRAGMENT_CACHE_MAX_AGE_DAYS = float(os.getenv('FRAGMENT_CACHE_MAX_AGE_DAYS', '7'))
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """Возвращает sha256 содержимого файла (читается кусками, чтобы не грузить видео в память целиком)."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def bytes_hash(data):
+    """Возвращает sha256 данных в памяти (например, сырого кадра слайда)."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def fragment_cache_key(slide_hash, speaker_hash, start, end, encoder_settings, rendition):
+    """
+    Ключ фрагмента: хэш картинки слайда, хэш исходного видео спикера, границы фрагмента,
+    настройки кодирования и вариант качества.
+    """
+    payload = json.dumps({
+        'slide': slide_hash,
+        'speaker': speaker_hash,
+        'start': start,
+        'end': end,
+        'encoder': encoder_settings,
+        'rendition': rendition,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def fragment_cache_path(key, ext='.mp4'):
+    return os.path.join(FRAGMENT_CACHE_DIR, f'{key}{ext}')
+
+
+def get_cached_fragment(key, ext='.mp4'):
+    """Возвращает путь к фрагменту из кэша или None. Обновляет время доступа, чтобы фрагмент не был вычищен."""
+    path = fragment_cache_path(key, ext)
+    if not os.path.exists(path):
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        # Файл мог быть удален параллельной очисткой
+        return None
+    return path
+
+
+def store_fragment(key, fragment_path, ext='.mp4'):
+    """
+    Перемещает готовый фрагмент в кэш и возвращает новый путь.
+    Файл появляется в кэше атомарно (os.replace внутри FRAGMENT_CACHE_DIR), так что параллельные задачи
+    не увидят недописанный файл. Если временная папка задачи на другой файловой системе,
+    фрагмент сначала копируется во временный файл внутри кэша.
+    """
+    os.makedirs(FRAGMENT_CACHE_DIR, exist_ok=True)
+    path = fragment_cache_path(key, ext)
+    try:
+        os.replace(fragment_path, path)
+        return path
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix=ext, dir=FRAGMENT_CACHE_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as dst, open(fragment_path, 'rb') as src:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.remove(fragment_path)
+    return path
+
+
+def prune_fragment_cache(max_age_days=FRAGMENT_CACHE_MAX_AGE_DAYS):
+    """Удаляет фрагменты, к которым не обращались дольше max_age_days."""
+    if not os.path.isdir(FRAGMENT_CACHE_DIR):
+        return
+    deadline = time.time() - max_age_days * 24 * 3600
+    for name in os.listdir(FRAGMENT_CACHE_DIR):
+        path = os.path.join(FRAGMENT_CACHE_DIR, name)
+        try:
+            if os.path.getmtime(path) < deadline:
+                os.remove(path)
+        except OSError as e:
+            logging.warning(f"Could not prune cached fragment {path}: {e}")
@@ -1,8 +1,11 @@
 # generator.py
 import base64
+import functools
 import io
+import os
 from typing import Any, Dict, List, Optional
 
+import pptx
 from pptx import Presentation
 from pptx.dml.color import RGBColor
 from pptx.enum.text import MSO_AUTO_SIZE
@@ -23,6 +26,21 @@ CONTENT_TYPE_IMAGE = "image"
 CONTENT_TYPE_BULLETS_HEADER = "bullet_points_header"
 
 
+@functools.lru_cache(maxsize=1)
+def load_default_template() -> bytes:
+    """Читает встроенный шаблон python-pptx один раз на процесс, дальше он берется из памяти."""
+    with open(os.path.join(os.path.dirname(pptx.__file__), "templates", "default.pptx"), "rb") as f:
+        return f.read()
+
+
+def prewarm() -> None:
+    """
+    Прогревает процесс перед первой задачей: загружает шаблон и один раз собирает пустую презентацию,
+    чтобы python-pptx и lxml подгрузили все нужное заранее. Используется как initializer пулов процессов.
+    """
+    Presentation(io.BytesIO(load_default_template())).save(io.BytesIO())
+
+
 class PresentationGenerator:
     """
     Генерирует .pptx файл на основе словаря, полученного из JSON.
@@ -32,7 +50,7 @@ class PresentationGenerator:
         if "slides" not in data:
             raise KeyError("Ключ 'slides' не найден в предоставленных данных.")
         self.data = data
-        self.prs = Presentation()
+        self.prs = Presentation(io.BytesIO(load_default_template()))
         self.prs.slide_width = Inches(10.8)
         self.prs.slide_height = Inches(10.8)
 
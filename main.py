@@ -5,21 +5,36 @@ import shutil
 import traceback
 
 from fastapi import FastAPI, Request, Form, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse, RedirectResponse
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse, RedirectResponse, Response
 from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from starlette.background import BackgroundTask
 
-from video_processor import process_video_with_presentation
 from generator import PresentationGenerator
-from celery_worker import create_video_task # Наша новая Celery задача
+from course_bulk import parse_courses, stream_presentations_zip, start_bulk_pool, shutdown_bulk_pool
+from celery_worker import celery_app, create_video_task # Наша новая Celery задача
 from celery.result import AsyncResult
+from storage import get_storage
+from video_settings import validate_renditions, validate_encoding_profile
 
 app = FastAPI(
     title="PPTX Generator API",
     description="API для генерации презентаций PowerPoint из JSON.",
 )
 
+
+@app.on_event("startup")
+def startup_bulk_pool():
+    """Пул процессов для /generate-presentations/bulk создается один раз и общий для всех запросов."""
+    start_bulk_pool()
+
+
+@app.on_event("shutdown")
+def stop_bulk_pool():
+    shutdown_bulk_pool()
+
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 UPLOADS_DIR = "uploads"
@@ -70,37 +85,80 @@ async def create_presentation(presentation_json: str = Form(...)):
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {e}")
 
 
+@app.post(
+    "/generate-presentations/bulk",
+    responses={
+        200: {
+            "content": {"application/zip": {}},
+            "description": "ZIP-архив с .pptx файлом на каждый курс",
+        },
+        400: {"description": "Некорректные входные данные"},
+    }
+)
+async def create_presentations_bulk(request: Request):
+    """
+    Принимает NDJSON (по курсу в строке) или JSON с несколькими курсами в формате
+    course_title + slides, генерирует презентации параллельно и отдает ZIP-архив потоком,
+    по мере готовности каждой презентации.
+    """
+    try:
+        courses = parse_courses(await request.body())
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {
+        'Content-Disposition': 'attachment; filename="presentations.zip"'
+    }
+    return StreamingResponse(stream_presentations_zip(courses), media_type="application/zip", headers=headers)
+
+
 # ИЗМЕНЕННЫЙ эндпоинт для генерации видео
 @app.post("/generate-video")
 async def generate_video_endpoint(
         json_file: UploadFile = File(...),
         presentation_file: UploadFile = File(...),
-        video_file: UploadFile = File(...)
+        video_file: UploadFile = File(...),
+        renditions: list[str] = Form(default=[]),
+        hls: bool = Form(default=False),
+        encoding_profile: str = Form(default='default'),
+        target_size_mb: float | None = Form(default=None)
 ):
     """
-    Принимает файлы, сохраняет их и запускает фоновую задачу.
+    Принимает файлы, сохраняет их в хранилище и запускает фоновую задачу.
     Сразу же перенаправляет пользователя на страницу статуса.
     """
     try:
+        # Неверные параметры отклоняем сразу, до загрузки файлов и постановки задачи в очередь
+        try:
+            renditions = validate_renditions(renditions)
+            encoding_profile = validate_encoding_profile(encoding_profile)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if target_size_mb is not None and target_size_mb <= 0:
+            raise HTTPException(status_code=400, detail="Целевой размер файла должен быть больше нуля")
+
         # Сохраняем файлы с уникальными именами, чтобы избежать конфликтов
         task_id = str(uuid.uuid4())
-        json_path = os.path.join(UPLOADS_DIR, f"{task_id}_{json_file.filename}")
-        pres_path = os.path.join(UPLOADS_DIR, f"{task_id}_{presentation_file.filename}")
-        video_path = os.path.join(UPLOADS_DIR, f"{task_id}_{video_file.filename}")
+        storage = get_storage()
+        json_key = f"inputs/{task_id}_{os.path.basename(json_file.filename)}"
+        pres_key = f"inputs/{task_id}_{os.path.basename(presentation_file.filename)}"
+        video_key = f"inputs/{task_id}_{os.path.basename(video_file.filename)}"
 
-        with open(json_path, "wb") as buffer:
-            shutil.copyfileobj(json_file.file, buffer)
-        with open(pres_path, "wb") as buffer:
-            shutil.copyfileobj(presentation_file.file, buffer)
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(video_file.file, buffer)
+        # Загрузка в хранилище (в том числе многокомпонентная в S3) блокирующая,
+        # поэтому выполняется в пуле потоков, чтобы не останавливать обработку остальных запросов
+        await run_in_threadpool(storage.save_fileobj, json_key, json_file.file)
+        await run_in_threadpool(storage.save_fileobj, pres_key, presentation_file.file)
+        await run_in_threadpool(storage.save_fileobj, video_key, video_file.file)
 
         # Запускаем фоновую задачу
-        task = create_video_task.delay(json_path, pres_path, video_path)
+        task = create_video_task.delay(json_key, pres_key, video_key, renditions, hls,
+                                        encoding_profile=encoding_profile, target_size_mb=target_size_mb)
 
         # Перенаправляем пользователя на страницу статуса
         return RedirectResponse(url=f"/video-status/{task.id}", status_code=303)
 
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         return HTMLResponse(content=f"<h1>Ошибка при запуске задачи: {e}</h1>", status_code=500)
@@ -118,22 +176,36 @@ async def read_root(request: Request):
 
 
 # НОВЫЙ эндпоинт для скачивания готового файла
+# Эндпоинты отдачи результатов — обычные def: обращения к хранилищу (в S3 это блокирующие запросы boto3)
+# и к Redis выполняются в пуле потоков FastAPI и не останавливают обработку остальных запросов
 @app.get("/download-video/{task_id}")
-async def download_video(task_id: str):
+def download_video(task_id: str, rendition: str | None = None):
     """
     Отдает готовый видеофайл для скачивания.
+    Параметр rendition (например, ?rendition=720p) выбирает один из дополнительных вариантов качества.
     """
     task_result = AsyncResult(task_id)
     if not task_result.ready() or task_result.status != 'SUCCESS':
         raise HTTPException(status_code=404, detail="Задача не завершена или завершилась с ошибкой")
 
     result_info = task_result.result
-    file_path = result_info.get('result_path')
+    if rendition and rendition != '1080p':
+        result_info = result_info.get('renditions', {}).get(rendition)
+        if not result_info:
+            raise HTTPException(status_code=404, detail=f"Вариант качества {rendition} не был запрошен")
+    result_key = result_info.get('result_key')
     filename = result_info.get('result_filename', 'video.mp4')
 
-    if not os.path.exists(file_path):
+    storage = get_storage()
+    if not result_key or not storage.exists(result_key):
         raise HTTPException(status_code=404, detail="Файл результата не найден")
 
+    # Из S3 файл скачивается напрямую по временной подписанной ссылке, минуя веб-сервис
+    url = storage.presigned_url(result_key, filename)
+    if url:
+        return RedirectResponse(url=url, status_code=307)
+    file_path = storage.local_path(result_key)
+
     # После скачивания файл можно удалить, чтобы не занимать место
     # Используем BackgroundTask для этого
     # from starlette.background import BackgroundTask
@@ -142,6 +214,89 @@ async def download_video(task_id: str):
     return FileResponse(path=file_path, filename=filename, media_type='video/mp4')
 
 
+@app.post("/cancel-video/{task_id}")
+async def cancel_video(task_id: str):
+    """
+    Отменяет задачу генерации видео.
+    Воркер получает SIGTERM, останавливает все запущенные процессы ffmpeg и удаляет временные файлы задачи.
+    """
+    celery_app.control.revoke(task_id, terminate=True, signal='SIGTERM')
+    return RedirectResponse(url=f"/video-status/{task_id}", status_code=303)
+
+
+HLS_MEDIA_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+}
+
+
+@app.get("/video-hls/{task_id}/{filename}")
+def get_video_hls(task_id: str, filename: str):
+    """
+    Отдает HLS-плейлист и сегменты готового видео.
+    Сегменты неизменяемы, поэтому их можно кэшировать на CDN по отдельности.
+    Плейлист всегда отдается через веб-сервис (относительные ссылки на сегменты должны вести сюда),
+    а сегменты из S3 — редиректом на подписанную ссылку.
+    """
+    ext = os.path.splitext(filename)[1]
+    if filename != os.path.basename(filename) or ext not in HLS_MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    task_result = AsyncResult(task_id)
+    if not task_result.ready() or task_result.status != 'SUCCESS':
+        raise HTTPException(status_code=404, detail="Задача не завершена или завершилась с ошибкой")
+
+    hls_prefix = task_result.result.get('hls_prefix')
+    key = f"{hls_prefix}/{filename}" if hls_prefix else None
+    storage = get_storage()
+    if not key or not storage.exists(key):
+        raise HTTPException(status_code=404, detail="HLS-версия не найдена")
+
+    if ext == '.m3u8':
+        return Response(content=storage.read(key), media_type=HLS_MEDIA_TYPES[ext])
+
+    url = storage.presigned_url(key)
+    if url:
+        return RedirectResponse(url=url, status_code=307)
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable'}
+    return FileResponse(path=storage.local_path(key), media_type=HLS_MEDIA_TYPES[ext], headers=headers)
+
+
+THUMBNAILS_MEDIA_TYPES = {
+    '.vtt': 'text/vtt',
+    '.jpg': 'image/jpeg',
+}
+
+
+@app.get("/video-thumbnails/{task_id}/{filename}")
+def get_video_thumbnails(task_id: str, filename: str):
+    """
+    Отдает спрайт миниатюр (sprite.jpg) и WebVTT-индекс (thumbnails.vtt) для предпросмотра при перемотке.
+    VTT ссылается на спрайт относительным путем, поэтому он отдается через веб-сервис, как и HLS-плейлист.
+    """
+    ext = os.path.splitext(filename)[1]
+    if filename != os.path.basename(filename) or ext not in THUMBNAILS_MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    task_result = AsyncResult(task_id)
+    if not task_result.ready() or task_result.status != 'SUCCESS':
+        raise HTTPException(status_code=404, detail="Задача не завершена или завершилась с ошибкой")
+
+    thumbnails_prefix = task_result.result.get('thumbnails_prefix')
+    key = f"{thumbnails_prefix}/{filename}" if thumbnails_prefix else None
+    storage = get_storage()
+    if not key or not storage.exists(key):
+        raise HTTPException(status_code=404, detail="Миниатюры не найдены")
+
+    if ext == '.vtt':
+        return Response(content=storage.read(key), media_type=THUMBNAILS_MEDIA_TYPES[ext])
+
+    url = storage.presigned_url(key)
+    if url:
+        return RedirectResponse(url=url, status_code=307)
+    return FileResponse(path=storage.local_path(key), media_type=THUMBNAILS_MEDIA_TYPES[ext])
+
+
 # НОВЫЙ эндпоинт для проверки статуса
 @app.get("/video-status/{task_id}", response_class=HTMLResponse)
 async def get_video_status(request: Request, task_id: str):
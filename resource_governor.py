@@ -0,0 +1,125 @@
+import fcntl
+import logging
+import os
+import signal
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Ограничение загрузки процессора на всю машину, общее для всех воркеров Celery и процессов batch_render.
+# Процессор поделен на CPU_SLOTS слотов, каждый слот — файл-блокировка в CPU_SLOTS_DIR.
+# Этап ffmpeg захватывает до FFMPEG_THREADS слотов на каждый свой пул потоков (декодеры, фильтры, кодировщики)
+# и делит между ними ровно столько потоков, сколько получил слотов,
+# поэтому суммарное число потоков ffmpeg на машине не превышает числа ядер.
+# Слоты набирает только один этап за раз (очередь — блокировка CPU_SLOTS_DIR/queue.lock), и он удерживает уже
+# захваченные слоты, пока не наберет нужный минимум: этапы, которым нужно 1-2 слота, не обгоняют бесконечно
+# этап склейки, которому нужно больше.
+# Блокировки flock снимаются ядром при завершении процесса, так что упавший воркер слоты не удерживает.
+CPU_SLOTS = int(os.getenv('CPU_SLOTS', str(os.cpu_count() or 1)))
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', '2'))
+CPU_SLOTS_DIR = os.getenv('CPU_SLOTS_DIR', os.path.join(tempfile.gettempdir(), 'pres_gen_cpu_slots'))
+# Новые этапы не запускаются, пока средняя загрузка на ядро выше этого порога
+# (например, из-за процессов, которые не проходят через governor)
+MAX_LOAD_PER_CPU = float(os.getenv('MAX_LOAD_PER_CPU', '1.5'))
+# Сколько секунд этап может ждать бюджет. Дальше он запускается с тем, что успел набрать
+# (не меньше одного потока на пул), чтобы задача не висела бесконечно на перегруженной машине.
+CPU_BUDGET_MAX_WAIT = float(os.getenv('CPU_BUDGET_MAX_WAIT', '600'))
+POLL_INTERVAL = 0.5
+WAIT_LOG_INTERVAL = 30
+
+
+def host_overloaded():
+    """Проверяет среднюю загрузку машины за последнюю минуту."""
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        return False
+    return load > (os.cpu_count() or 1) * MAX_LOAD_PER_CPU
+
+
+@contextmanager
+def signals_deferred(signums=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Откладывает доставку сигналов отмены на время блока. Обработчик отмены выбрасывает исключение
+    в произвольном месте кода, поэтому захват ресурса и его регистрация для освобождения
+    должны выполняться без прерываний, иначе ресурс утечет до конца жизни процесса.
+    """
+    previous = signal.pthread_sigmask(signal.SIG_BLOCK, signums)
+    try:
+        yield
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, previous)
+
+
+def _try_acquire(max_slots, fds):
+    """
+    Добавляет в fds файловые дескрипторы свободных слотов, пока их не станет max_slots.
+    Слоты, уже захваченные этим этапом, повторно не захватываются: flock на другом дескрипторе того же файла
+    конфликтует с нашей же блокировкой.
+    """
+    for i in range(CPU_SLOTS):
+        if len(fds) >= max_slots:
+            break
+        fd = os.open(os.path.join(CPU_SLOTS_DIR, f'slot_{i:03d}.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        fds.append(fd)
+
+
+def _wait_for_slots(threads, min_threads, fds):
+    """
+    Встает в очередь и набирает слоты в fds: до threads, но ждет, пока не наберется хотя бы min_threads.
+    Не ждет дольше CPU_BUDGET_MAX_WAIT.
+    """
+    queue_fd = os.open(os.path.join(CPU_SLOTS_DIR, 'queue.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        # Блокирующий flock прерывается сигналом отмены: обработчик выбросит исключение прямо отсюда
+        fcntl.flock(queue_fd, fcntl.LOCK_EX)
+        started = time.monotonic()
+        next_log = started
+        while True:
+            if not host_overloaded():
+                with signals_deferred():
+                    _try_acquire(threads, fds)
+            if len(fds) >= min_threads:
+                return
+            waited = time.monotonic() - started
+            if waited >= CPU_BUDGET_MAX_WAIT:
+                logging.warning(f"CPU budget wait exceeded {CPU_BUDGET_MAX_WAIT:g}s, "
+                                f"running with {len(fds)}/{min_threads} slots")
+                return
+            if time.monotonic() >= next_log:
+                logging.info(f"Waiting for CPU budget: {len(fds)}/{min_threads} slots, {waited:.0f}s so far")
+                next_log += WAIT_LOG_INTERVAL
+            time.sleep(POLL_INTERVAL)
+    finally:
+        # Закрытие дескриптора снимает блокировку очереди
+        os.close(queue_fd)
+
+
+@contextmanager
+def cpu_budget(threads=FFMPEG_THREADS, min_threads=1):
+    """
+    Выдает бюджет процессора на один этап: в порядке очереди захватывает до threads слотов,
+    дожидаясь хотя бы min_threads (по одному на каждый пул потоков ffmpeg), и возвращает их число —
+    столько потоков и нужно дать ffmpeg. При высокой конкуренции этапы получают меньше потоков,
+    а не ждут, пока освободится весь запрошенный бюджет.
+    """
+    threads = max(1, min(threads, CPU_SLOTS))
+    min_threads = max(1, min(min_threads, threads))
+    os.makedirs(CPU_SLOTS_DIR, exist_ok=True)
+    fds = []
+    try:
+        _wait_for_slots(threads, min_threads, fds)
+        yield max(1, len(fds))
+    finally:
+        _release(fds)
+
+
+def _release(fds):
+    for fd in fds:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
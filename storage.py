@@ -0,0 +1,160 @@
+import mimetypes
+import os
+import shutil
+from typing import BinaryIO, Optional
+
+# Хранилище входных файлов и результатов: общая папка (по умолчанию) или S3-совместимое хранилище.
+# S3 позволяет запускать воркеры на разных машинах: веб-сервис кладет туда исходники,
+# воркер скачивает их во временную папку, а результат публикует обратно.
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT', 'uploads')
+S3_BUCKET = os.getenv('S3_BUCKET', 'pres-gen')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')  # например, http://minio:9000 для MinIO
+# Адрес хранилища, доступный браузеру пользователя, для подписанных ссылок на скачивание
+# (например, http://localhost:9000). Подпись включает имя хоста, поэтому внутренний адрес
+# вроде http://minio:9000 в ссылке не годится. По умолчанию совпадает с S3_ENDPOINT_URL.
+S3_PUBLIC_ENDPOINT_URL = os.getenv('S3_PUBLIC_ENDPOINT_URL') or S3_ENDPOINT_URL
+PRESIGNED_URL_EXPIRES = int(os.getenv('PRESIGNED_URL_EXPIRES', '3600'))
+
+# Размер части при многокомпонентной (multipart) загрузке в S3
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def _content_type(key: str) -> str:
+    if key.endswith('.m3u8'):
+        return 'application/vnd.apple.mpegurl'
+    if key.endswith('.ts'):
+        return 'video/mp2t'
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+class LocalStorage:
+    """Хранилище в локальной (или смонтированной общей) папке. Ключ — относительный путь внутри root."""
+
+    def __init__(self, root: str = LOCAL_STORAGE_ROOT):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Недопустимый ключ хранилища: {key}")
+        return path
+
+    def save_fileobj(self, key: str, fileobj: BinaryIO) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as buffer:
+            shutil.copyfileobj(fileobj, buffer)
+
+    def fetch(self, key: str, scratch_dir: str) -> str:
+        """Возвращает локальный путь к файлу. Для локального хранилища файл не копируется."""
+        path = self._path(key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return path
+
+    def publish(self, local_path: str, key: str) -> None:
+        """Помещает готовый файл в хранилище под ключом key (перемещением, без копирования)."""
+        path = self._path(key)
+        if os.path.abspath(local_path) != os.path.abspath(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(local_path, path)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def read(self, key: str) -> bytes:
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Путь для отдачи файла напрямую через FileResponse."""
+        return self._path(key)
+
+    def presigned_url(self, key: str, filename: Optional[str] = None) -> Optional[str]:
+        # Локальное хранилище отдается самим веб-сервисом
+        return None
+
+
+class S3Storage:
+    """
+    S3-совместимое хранилище (AWS S3, MinIO). Загрузка идет потоком частями (multipart),
+    скачивание результатов — по временным подписанным ссылкам прямо из хранилища.
+    Учетные данные берутся из стандартных переменных AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY.
+    """
+
+    def __init__(self, bucket: str = S3_BUCKET, endpoint_url: Optional[str] = S3_ENDPOINT_URL,
+                 public_endpoint_url: Optional[str] = S3_PUBLIC_ENDPOINT_URL):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError as e:
+            raise RuntimeError("Для STORAGE_BACKEND=s3 нужен пакет boto3") from e
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        # Отдельный клиент только для подписи ссылок: запросов к хранилищу он не делает
+        self.presign_client = (boto3.client('s3', endpoint_url=public_endpoint_url)
+                               if public_endpoint_url != endpoint_url else self.client)
+        self.transfer_config = TransferConfig(multipart_chunksize=MULTIPART_CHUNK_SIZE,
+                                              multipart_threshold=MULTIPART_CHUNK_SIZE)
+
+    def save_fileobj(self, key: str, fileobj: BinaryIO) -> None:
+        self.client.upload_fileobj(fileobj, self.bucket, key, Config=self.transfer_config,
+                                   ExtraArgs={'ContentType': _content_type(key)})
+
+    def fetch(self, key: str, scratch_dir: str) -> str:
+        """Скачивает объект во временную папку воркера и возвращает локальный путь."""
+        path = os.path.join(scratch_dir, os.path.basename(key))
+        self.client.download_file(self.bucket, key, path, Config=self.transfer_config)
+        return path
+
+    def publish(self, local_path: str, key: str) -> None:
+        """Загружает готовый файл в хранилище и удаляет локальную копию."""
+        self.client.upload_file(local_path, self.bucket, key, Config=self.transfer_config,
+                                ExtraArgs={'ContentType': _content_type(key)})
+        os.remove(local_path)
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return False
+        return True
+
+    def read(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def local_path(self, key: str) -> Optional[str]:
+        return None
+
+    def presigned_url(self, key: str, filename: Optional[str] = None) -> Optional[str]:
+        params = {'Bucket': self.bucket, 'Key': key}
+        if filename:
+            params['ResponseContentDisposition'] = f'attachment; filename="{filename}"'
+        return self.presign_client.generate_presigned_url('get_object', Params=params, ExpiresIn=PRESIGNED_URL_EXPIRES)
+
+
+_storage = None
+
+
+def get_storage():
+    """Возвращает хранилище, выбранное переменной окружения STORAGE_BACKEND (local или s3)."""
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == 's3':
+            _storage = S3Storage()
+        elif STORAGE_BACKEND == 'local':
+            _storage = LocalStorage()
+        else:
+            raise ValueError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _storage
@@ -1,28 +1,100 @@
 from pdf2image import convert_from_path
-import subprocess
 import json
 import logging
 import tempfile
 import os
+import shutil
+from PIL import Image
 from PyPDF2 import PdfReader
-from fastapi.responses import HTMLResponse
+
+from ffmpeg_runner import run_ffmpeg, THREADS
+from video_settings import (RENDITIONS, NATIVE_RENDITION, HLS_SEGMENT_DURATION, HLS_PLAYLIST_NAME, ENCODING_PROFILES,
+                            DEFAULT_ENCODING_PROFILE, DEFAULT_AUDIO_BITRATE, MIN_VIDEO_BITRATE,
+                            validate_encoding_profile, validate_renditions)
+from fragment_cache import bytes_hash, file_hash, fragment_cache_key, get_cached_fragment, store_fragment, prune_fragment_cache
 
 
 
 logging.basicConfig(filename='app.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-def convert_pdf_to_images(pdf_path, output_folder='input'):
-    logging.info(f'+++++++++++++++++++++++++++ Converting PDF {pdf_path} to images in {output_folder}')
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    slides = convert_from_path(pdf_path)
-    image_paths = []
-    for i, slide in enumerate(slides):
-        image_path = os.path.join(output_folder, f'slide_{i+1:02d}.png')
-        slide.save(image_path, 'PNG')
-        image_paths.append(image_path)
-    return image_paths
+# Миниатюры для предпросмотра при перемотке: одна каждые THUMBNAIL_INTERVAL секунд,
+# собираются в спрайт по SPRITE_COLUMNS в ряд, координаты описываются в WebVTT.
+THUMBNAIL_INTERVAL = 10
+THUMBNAIL_SIZE = (160, 90)
+SPRITE_COLUMNS = 10
+SPRITE_FILENAME = 'sprite.jpg'
+THUMBNAILS_VTT_FILENAME = 'thumbnails.vtt'
+
+# Размер кадра слайда (левая часть итогового видео) и частота кадров видео со слайдом.
+SLIDE_SIZE = (1080, 1080)
+SLIDE_FRAMERATE = 25
+
+# Настройки кодирования фрагментов. Входят в ключ кэша фрагментов:
+# при их изменении все фрагменты будут перекодированы заново.
+ENCODER_SETTINGS = {
+    'video_codec': 'libx264',
+    'audio_codec': 'aac',
+    'pix_fmt': 'yuv420p',
+    'slide_scale': '1080:1080',
+    'slide_input': 'rawvideo',
+    'speaker_scale': '840:1080',
+}
+
+
+def target_video_bitrate(target_size_mb, duration, profile=DEFAULT_ENCODING_PROFILE):
+    """
+    Считает битрейт видео (кбит/с), при котором итоговый файл длительностью duration секунд
+    уложится примерно в target_size_mb мегабайт с учетом битрейта аудио профиля.
+    """
+    audio_bitrate = ENCODING_PROFILES[profile].get('audio_bitrate', DEFAULT_AUDIO_BITRATE)
+    bitrate = int(target_size_mb * 8 * 1024 / duration) - audio_bitrate
+    if bitrate < MIN_VIDEO_BITRATE:
+        logging.warning(f"Target size {target_size_mb} MB is too small for {duration}s, "
+                        f"using {MIN_VIDEO_BITRATE} kbit/s")
+        bitrate = MIN_VIDEO_BITRATE
+    return bitrate
+
+
+def encoding_args(profile=DEFAULT_ENCODING_PROFILE, video_bitrate=None):
+    """
+    Собирает аргументы кодирования для выходного файла ffmpeg.
+    Число потоков кодировщика задается при запуске бюджетом процессора (THREADS, см. run_ffmpeg).
+    video_bitrate (кбит/с) включает режим целевого битрейта вместо CRF профиля.
+    """
+    settings = ENCODING_PROFILES[profile]
+    args = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-threads', THREADS]
+    if 'preset' in settings:
+        args += ['-preset', settings['preset']]
+    if video_bitrate:
+        args += ['-b:v', f'{video_bitrate}k', '-maxrate', f'{int(video_bitrate * 1.5)}k',
+                 '-bufsize', f'{video_bitrate * 2}k']
+    elif 'crf' in settings:
+        args += ['-crf', str(settings['crf'])]
+    if 'x264_params' in settings:
+        args += ['-x264-params', settings['x264_params']]
+    if 'keyframe_interval' in settings:
+        args += ['-force_key_frames', f"expr:gte(t,n_forced*{settings['keyframe_interval']})"]
+    args += ['-c:a', 'aac']
+    if 'audio_bitrate' in settings:
+        args += ['-b:a', f"{settings['audio_bitrate']}k"]
+    return args
+
+
+def rasterize_pdf(pdf_path, size=SLIDE_SIZE):
+    """
+    Растеризует страницы PDF сразу в нужном размере и возвращает сырые RGB-кадры (bytes) по одному на слайд.
+    Кадры остаются в памяти и передаются в ffmpeg через stdin, без промежуточных PNG на диске.
+    """
+    logging.info(f'+++++++++++++++++++++++++++ Rasterizing PDF {pdf_path} to {size[0]}x{size[1]} frames')
+    frames = []
+    for slide in convert_from_path(pdf_path, size=size):
+        slide = slide.convert('RGB')
+        if slide.size != size:
+            slide = slide.resize(size)
+        frames.append(slide.tobytes())
+    return frames
+
 
 def cut_video(input_video_path, start, end, output_video_path, video_codec = 'libx264', audio_codec = 'aac'):
     logging.info('+++++++++++++++++++++++++++ Cutting video')
@@ -30,43 +102,51 @@ def cut_video(input_video_path, start, end, output_video_path, video_codec = 'li
         'ffmpeg',
         '-ss', str(start),
         '-to', str(end),
+        '-threads', THREADS,
         '-i', input_video_path,
         '-hide_banner',
         '-c:v', video_codec,
         '-c:a', audio_codec,
+        '-threads', THREADS,
         '-y',
         output_video_path
     ]
-    subprocess.run(cmd, check=True)
+    run_ffmpeg(cmd, stage='cut', duration=end - start)
 
 
-def slide_to_video(slide_img_path, duration, output_video_path):
+def slide_frame_to_video(frame, duration, output_video_path, size=SLIDE_SIZE):
     """
-    -loop 1 — зациклить входное изображение (то есть повторять его) для создания видео.
-    -i <file> — входной файл (изображение).
+    Превращает кадр слайда в видео длительностью duration секунд. Кадр приходит сырыми RGB-байтами через stdin.
+
+    -f rawvideo -pix_fmt rgb24 -s WxH — формат входного кадра без контейнера и сжатия.
+    -i - — читать вход из stdin.
+    -vf loop=loop=-1:size=1 — бесконечно повторять единственный кадр, длительность ограничивает -t.
     -t <duration> — длительность выходного видео в секундах.
-    -vf scale=1280:1080 — видеофильтр (vf) для масштабирования видео до 1280x1080.
-    -c:v libx264 — кодек видео.
-    -y — перезаписывать без запроса.
     """
-    logging.info('+++++++++++++++++++++++++++ Slide to video')
+    logging.info('+++++++++++++++++++++++++++ Slide frame to video')
     cmd = [
         'ffmpeg',
-        '-loop', '1',
-        '-i', slide_img_path,
+        '-f', 'rawvideo',
+        '-pix_fmt', 'rgb24',
+        '-s', f'{size[0]}x{size[1]}',
+        '-framerate', str(SLIDE_FRAMERATE),
+        '-i', '-',
         '-hide_banner',
         '-t', str(duration),
-        '-vf', 'scale=1080:1080',  # Левая часть (2/3 ширины)
+        '-vf', 'loop=loop=-1:size=1:start=0',
         '-c:v', 'libx264',
         '-pix_fmt', 'yuv420p',
+        '-threads', THREADS,
         '-y',
         output_video_path
     ]
-    subprocess.run(cmd, check=True)
+    run_ffmpeg(cmd, stage='slide', input_data=frame, duration=duration)
 
 
-def resize_video(input_video_path, output_video_path):
+def resize_video(input_video_path, output_video_path, duration=None):
     """
+    duration — длительность фрагмента в секундах, от нее зависит таймаут этапа.
+
     -i <file> — входной файл.
     -vf scale=640:1080 — масштабирует видео до 640 по ширине и 1080 по высоте.
     -c:v libx264 — кодек видео.
@@ -74,76 +154,276 @@ def resize_video(input_video_path, output_video_path):
     """
     cmd = [
         'ffmpeg',
+        '-threads', THREADS,
         '-i', input_video_path,
         '-hide_banner',
         '-vf', 'scale=840:1080',
         '-c:v', 'libx264',
         '-pix_fmt', 'yuv420p',
+        '-threads', THREADS,
         '-y',
         output_video_path
     ]
-    subprocess.run(cmd, check=True)
+    run_ffmpeg(cmd, stage='resize', duration=duration)
 
 
-def combine_videos(slide_video_path, speaker_video_path, output_video_path):
+def combine_videos(slide_video_path, speaker_video_path, output_video_path, renditions=None,
+                   profile=DEFAULT_ENCODING_PROFILE, video_bitrate=None, thumbnails_pattern=None, duration=None):
     """
     Объединяет два видео в одно, расположив их горизонтально рядом (слайд слева, спикер справа), и берёт аудио
     только из видео спикера.
 
+    renditions — необязательный словарь {имя варианта: путь}. Если задан, склеенный поток разделяется
+    фильтром split и дополнительно масштабируется под каждый вариант в том же запуске ffmpeg,
+    так что декодирование и склейка выполняются один раз.
+    profile, video_bitrate — профиль кодирования и целевой битрейт (см. encoding_args). Для вариантов
+    качества целевой битрейт уменьшается пропорционально числу пикселей.
+    thumbnails_pattern — необязательный шаблон имени JPEG-файлов (например, 'thumbs/%04d.jpg'): из того же
+    склеенного потока раз в THUMBNAIL_INTERVAL секунд сохраняется уменьшенный кадр для спрайта миниатюр.
+    duration — длительность фрагмента в секундах, от нее зависит таймаут этапа.
+
+    -threads перед -i — потоки декодера этого входа; вместе с потоками фильтров и кодировщиков делят
+                        бюджет процессора этапа (см. run_ffmpeg).
     -i <file> (две раза) — два входных видео.
     -filter_complex '[0:v][1:v]hstack=inputs=2[v]' — комплексный фильтр, который объединяет два видеопотока
                                                     горизонтально (hstack), результат сохраняется в метку [v].
     -map '[v]' — взять из фильтра выходное видео.
     -map '1:a?' — взять аудио из второго входного файла (индекс 1), знак вопроса ? значит "если аудио есть, то взять,
                   если нет — не ругаться".
-    -c:v libx264 — кодек видео.
+    -c:v libx264 — кодек видео (параметры зависят от профиля).
     -c:a aac — кодек аудио.
     -y — перезаписывать без запроса.
     """
     logging.info('+++++++++++++++++++++++++++ Combining videos')
+    renditions = renditions or {}
+    filter_complex = '[0:v][1:v]hstack=inputs=2[v]'
+    split_count = 1 + len(renditions) + (1 if thumbnails_pattern else 0)
+    if split_count > 1:
+        labels = ''.join(f'[r{i}]' for i in range(len(renditions)))
+        if thumbnails_pattern:
+            labels += '[t]'
+        filter_complex = f'[0:v][1:v]hstack=inputs=2,split={split_count}[v]{labels}'
+        for i, name in enumerate(renditions):
+            filter_complex += f';[r{i}]scale=-2:{RENDITIONS[name]}[s{i}]'
+        if thumbnails_pattern:
+            width, height = THUMBNAIL_SIZE
+            # Первый кадр и далее не чаще раза в THUMBNAIL_INTERVAL секунд
+            select = f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{THUMBNAIL_INTERVAL})'"
+            filter_complex += f';[t]{select},scale={width}:{height}[th]'
+
     cmd = [
         'ffmpeg',
+        '-threads', THREADS,
         '-i', slide_video_path,
+        '-threads', THREADS,
         '-i', speaker_video_path,
         '-hide_banner',
-        '-filter_complex', '[0:v][1:v]hstack=inputs=2[v]',
+        '-y',
+        '-filter_complex_threads', THREADS,
+        '-filter_complex', filter_complex,
         '-map', '[v]',
         '-map', '1:a?',
-        '-c:v', 'libx264',
-        '-pix_fmt', 'yuv420p',
-        '-c:a', 'aac',
-        '-y',
-        output_video_path
+        *encoding_args(profile, video_bitrate),
+        output_video_path,
     ]
-    subprocess.run(cmd, check=True)
+    for i, (name, path) in enumerate(renditions.items()):
+        scale = (RENDITIONS[name] / RENDITIONS[NATIVE_RENDITION]) ** 2
+        rendition_bitrate = max(int(video_bitrate * scale), MIN_VIDEO_BITRATE) if video_bitrate else None
+        cmd += [
+            '-map', f'[s{i}]',
+            '-map', '1:a?',
+            *encoding_args(profile, rendition_bitrate),
+            path,
+        ]
+    if thumbnails_pattern:
+        # Кадры миниатюр крошечные, отдельный пул потоков кодировщику JPEG не нужен
+        cmd += ['-map', '[th]', '-fps_mode', 'vfr', '-q:v', '5', '-threads', '1', '-f', 'image2', thumbnails_pattern]
+    run_ffmpeg(cmd, stage='combine', duration=duration)
+
+
+def write_chapters_metadata(chapters, metadata_path):
+    """
+    Записывает главы в формате FFMETADATA. chapters — список (название, начало, конец) в секундах
+    от начала итогового видео.
+    """
+    def escape(value):
+        for ch in ('\\', '=', ';', '#', '\n'):
+            value = value.replace(ch, '\\' + ch)
+        return value
 
+    with open(metadata_path, 'w', encoding='utf-8') as f:
+        f.write(';FFMETADATA1\n')
+        for title, start, end in chapters:
+            f.write('[CHAPTER]\nTIMEBASE=1/1000\n')
+            f.write(f'START={int(start * 1000)}\nEND={int(end * 1000)}\n')
+            f.write(f'title={escape(str(title))}\n')
 
-def concat_videos(video_list, output_video_path):
+
+def concat_videos(video_list, output_video_path, list_path='inputs.txt', metadata_path=None, duration=None):
     """
     Склеивает несколько видеофайлов последовательно (конкатенация), без перекодирования.
+    list_path — куда записать список файлов для concat-демультиплексора.
+    metadata_path — необязательный файл FFMETADATA (см. write_chapters_metadata), главы из него
+    записываются в итоговый MP4 в том же проходе.
+    duration — суммарная длительность видео в секундах, от нее зависит таймаут этапа.
     """
     logging.info('+++++++++++++++++++++++++++ Concatinating videos')
-    with open('inputs.txt', 'w') as f:
+    with open(list_path, 'w') as f:
         for v in video_list:
-            f.write(f"file '{v}'\n")
+            f.write(f"file '{os.path.abspath(v)}'\n")
     cmd = [
         'ffmpeg',
         '-f', 'concat',
         '-safe', '0',
-        '-i', 'inputs.txt',
+        '-i', list_path,
         '-hide_banner',
         '-c', 'copy',
         '-y',
         output_video_path
     ]
-    subprocess.run(cmd, check=True)
+    if metadata_path:
+        cmd[cmd.index('-hide_banner'):cmd.index('-hide_banner')] = [
+            '-f', 'ffmetadata', '-i', metadata_path,
+            '-map', '0', '-map_metadata', '1', '-map_chapters', '1',
+        ]
+    run_ffmpeg(cmd, stage='concat', duration=duration)
 
 
-def process_video_with_presentation(json_path: str, presentation_path: str, video_path: str, output_path: str):
+def thumbnails_to_strip(frames_dir, duration, strip_path):
+    """
+    Склеивает миниатюры одного фрагмента в горизонтальную полосу (ее и кэшируем вместе с фрагментом).
+    Лишние кадры за концом фрагмента отбрасываются.
+    """
+    width, height = THUMBNAIL_SIZE
+    count = max(1, -(-int(duration * 1000) // (THUMBNAIL_INTERVAL * 1000)))
+    files = sorted(os.listdir(frames_dir))[:count]
+    strip = Image.new('RGB', (width * max(len(files), 1), height))
+    for i, name in enumerate(files):
+        with Image.open(os.path.join(frames_dir, name)) as thumb:
+            strip.paste(thumb.convert('RGB').resize(THUMBNAIL_SIZE), (i * width, 0))
+    strip.save(strip_path, 'JPEG', quality=85)
+
+
+def _vtt_timestamp(seconds):
+    ms = int(round(seconds * 1000))
+    return f'{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}'
+
+
+def build_thumbnail_sprite(strips, sprite_path, vtt_path):
+    """
+    Собирает спрайт миниатюр и WebVTT-индекс для предпросмотра при перемотке.
+    strips — список (начало фрагмента, длительность, путь к полосе миниатюр фрагмента).
+    В VTT на спрайт ссылаемся по имени файла, поэтому оба файла должны лежать рядом.
+    """
+    width, height = THUMBNAIL_SIZE
+    cues = []
+    thumbs = []
+    for offset, duration, strip_path in strips:
+        with Image.open(strip_path) as strip:
+            for i in range(strip.width // width):
+                start = offset + i * THUMBNAIL_INTERVAL
+                if start >= offset + duration:
+                    break
+                thumbs.append(strip.crop((i * width, 0, (i + 1) * width, height)))
+                cues.append((start, min(start + THUMBNAIL_INTERVAL, offset + duration)))
+
+    rows = max(1, -(-len(thumbs) // SPRITE_COLUMNS))
+    sprite = Image.new('RGB', (width * min(max(len(thumbs), 1), SPRITE_COLUMNS), height * rows))
+    sprite_name = os.path.basename(sprite_path)
+    with open(vtt_path, 'w', encoding='utf-8') as f:
+        f.write('WEBVTT\n')
+        for i, (thumb, (start, end)) in enumerate(zip(thumbs, cues)):
+            x, y = (i % SPRITE_COLUMNS) * width, (i // SPRITE_COLUMNS) * height
+            sprite.paste(thumb, (x, y))
+            f.write(f'\n{_vtt_timestamp(start)} --> {_vtt_timestamp(end)}\n')
+            f.write(f'{sprite_name}#xywh={x},{y},{width},{height}\n')
+    sprite.save(sprite_path, 'JPEG', quality=80)
+
+
+def hls_segment_times(durations, segment_duration=HLS_SEGMENT_DURATION):
+    """
+    Считает моменты разреза HLS-сегментов: на каждой смене слайда плюс каждые segment_duration секунд
+    внутри длинных слайдов. Смена слайда всегда попадает на границу сегмента.
+    """
+    times = []
+    slide_start = 0
+    for duration in durations:
+        t = slide_start + segment_duration
+        while t < slide_start + duration:
+            times.append(t)
+            t += segment_duration
+        slide_start += duration
+        times.append(slide_start)
+    # Последняя граница — конец видео, резать там нечего
+    return times[:-1]
+
+
+def concat_videos_hls(video_list, output_dir, segment_times, duration=None):
+    """
+    Склеивает фрагменты сразу в HLS (MPEG-TS сегменты + плейлист) без перекодирования.
+
+    -f segment — сегментирующий мультиплексор, режет поток в моменты из -segment_times
+                 (ближайший ключевой кадр; каждый фрагмент начинается с ключевого кадра,
+                 поэтому смены слайдов совпадают с границами сегментов).
+    -segment_list_type m3u8 — записать плейлист HLS (VOD, с EXT-X-ENDLIST).
+    duration — суммарная длительность видео в секундах, от нее зависит таймаут этапа.
+    """
+    logging.info(f'+++++++++++++++++++++++++++ Writing HLS into {output_dir}')
+    os.makedirs(output_dir, exist_ok=True)
+    list_path = os.path.join(output_dir, 'inputs.txt')
+    with open(list_path, 'w') as f:
+        for v in video_list:
+            f.write(f"file '{os.path.abspath(v)}'\n")
+    cmd = [
+        'ffmpeg',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', list_path,
+        '-hide_banner',
+        '-map', '0',
+        '-c', 'copy',
+        '-f', 'segment',
+        '-segment_format', 'mpegts',
+        '-segment_list', os.path.join(output_dir, HLS_PLAYLIST_NAME),
+        '-segment_list_type', 'm3u8',
+        '-reset_timestamps', '0',
+        '-y',
+        os.path.join(output_dir, 'segment_%05d.ts')
+    ]
+    if segment_times:
+        cmd[-2:-2] = ['-segment_times', ','.join(f'{t:g}' for t in segment_times), '-segment_time_delta', '0.05']
+    try:
+        run_ffmpeg(cmd, stage='hls', duration=duration)
+    finally:
+        if os.path.exists(list_path):
+            os.remove(list_path)
+
+
+def process_video_with_presentation(json_path: str, presentation_path: str, video_path: str, output_path: str,
+                                    renditions: dict[str, str] | None = None, hls_dir: str | None = None,
+                                    encoding_profile: str = DEFAULT_ENCODING_PROFILE,
+                                    target_bitrate: int | None = None, target_size_mb: float | None = None,
+                                    thumbnails_dir: str | None = None):
     """
     Основная функция обработки видео.
+    renditions — необязательный словарь {имя варианта качества: путь}, см. RENDITIONS.
+    Все варианты собираются за один проход вместе с основным видео.
+    hls_dir — если задан, в эту папку дополнительно пишется HLS-версия (сегменты + playlist.m3u8),
+    сегменты режутся по сменам слайдов.
+    encoding_profile — профиль кодирования из ENCODING_PROFILES.
+    target_bitrate (кбит/с) или target_size_mb — режим целевого битрейта вместо CRF профиля;
+    размер файла пересчитывается в битрейт по суммарной длительности слайдов.
+    Главы (название слайда, start, end) записываются в MP4 всегда, на этапе склейки фрагментов.
+    thumbnails_dir — если задан, туда пишутся спрайт миниатюр (sprite.jpg) и индекс thumbnails.vtt;
+    кадры для них берутся из того же прохода, в котором кодируются фрагменты.
     В случае ошибки выбрасывает исключение ValueError.
     """
+    renditions = renditions or {}
+    unknown = [name for name in renditions if name not in RENDITIONS or name == NATIVE_RENDITION]
+    if unknown:
+        raise ValueError(f"Неподдерживаемые варианты качества: {', '.join(unknown)}")
+    encoding_profile = validate_encoding_profile(encoding_profile)
+
     logging.info(f"+++++++++++++++++++++++++++ Loading JSON data from {json_path}")
     with open(json_path, 'r', encoding='utf-8') as f:
         data = json.load(f)
@@ -156,17 +436,30 @@ def process_video_with_presentation(json_path: str, presentation_path: str, vide
         # ИСПРАВЛЕНО: Выбрасываем исключение вместо return
         raise ValueError(error_message)
 
-    # Убедимся, что папка для временных файлов существует
-    temp_folder = os.path.dirname(output_path)
-    os.makedirs(temp_folder, exist_ok=True)
+    video_bitrate = target_bitrate
+    if target_size_mb:
+        total_duration = sum(slide['end'] - slide['start'] for slide in slides_data_list)
+        video_bitrate = target_video_bitrate(target_size_mb, total_duration, encoding_profile)
+        logging.info(f"Target size {target_size_mb} MB -> video bitrate {video_bitrate} kbit/s")
+    encoder_settings = {**ENCODER_SETTINGS, 'profile': encoding_profile,
+                        'args': encoding_args(encoding_profile, video_bitrate)}
 
-    slide_image_paths = convert_pdf_to_images(presentation_path, output_folder=temp_folder)
+    # Отдельная папка для временных файлов этой задачи: параллельные задачи не мешают друг другу,
+    # а при ошибке или отмене вся папка удаляется целиком
+    output_folder = os.path.dirname(output_path)
+    os.makedirs(output_folder, exist_ok=True)
+    temp_folder = tempfile.mkdtemp(prefix='job_', dir=output_folder)
 
     video_fragments = []
-    # Список временных файлов, созданных в цикле, для очистки
-    cycle_temp_files = list(slide_image_paths)
+    rendition_fragments = {name: [] for name in renditions}
+    chapters = []
+    thumbnail_strips = []
+    offset = 0
 
     try:
+        slide_frames = rasterize_pdf(presentation_path)
+        speaker_hash = file_hash(video_path)
+
         for i, slide_data in enumerate(slides_data_list):
             logging.info(
                 f"+++++++++++++++++++++++++++ Processing slide {i + 1}/{len(slides_data_list)}: '{slide_data.get('title', 'No Title')}' ---")
@@ -175,41 +468,82 @@ def process_video_with_presentation(json_path: str, presentation_path: str, vide
             end = slide_data['end']
             duration = end - start
 
-            slide_img_path = slide_image_paths[i]
+            slide_frame = slide_frames[i]
+            chapters.append((slide_data.get('title') or f'Слайд {i + 1}', offset, offset + duration))
+
+            slide_hash = bytes_hash(slide_frame)
+            cache_keys = {
+                name: fragment_cache_key(slide_hash, speaker_hash, start, end, encoder_settings, name)
+                for name in [NATIVE_RENDITION, *renditions]
+            }
+            cached = {name: get_cached_fragment(key) for name, key in cache_keys.items()}
+            if thumbnails_dir:
+                thumbnails_key = fragment_cache_key(slide_hash, speaker_hash, start, end, encoder_settings,
+                                                    f'thumbnails_{THUMBNAIL_INTERVAL}_{THUMBNAIL_SIZE}')
+                cached['thumbnails'] = get_cached_fragment(thumbnails_key, ext='.jpg')
+            if all(cached.values()):
+                logging.info(f"Slide {i + 1}: fragment found in cache, skipping encoding")
+                video_fragments.append(cached[NATIVE_RENDITION])
+                for name in renditions:
+                    rendition_fragments[name].append(cached[name])
+                if thumbnails_dir:
+                    thumbnail_strips.append((offset, duration, cached['thumbnails']))
+                offset += duration
+                continue
 
             speaker_cut = os.path.join(temp_folder, f'speaker_{i:02d}.mp4')
             cut_video(video_path, start, end, speaker_cut)
-            cycle_temp_files.append(speaker_cut)
 
             slide_vid = os.path.join(temp_folder, f'slide_{i:02d}.mp4')
-            slide_to_video(slide_img_path, duration, slide_vid)
-            cycle_temp_files.append(slide_vid)
+            slide_frame_to_video(slide_frame, duration, slide_vid)
 
             speaker_resized = os.path.join(temp_folder, f'speaker_{i:02d}_resized.mp4')
-            resize_video(speaker_cut, speaker_resized)
-            cycle_temp_files.append(speaker_resized)
+            resize_video(speaker_cut, speaker_resized, duration=duration)
 
             combined = os.path.join(temp_folder, f'combined_{i:02d}.mp4')
-            combine_videos(slide_vid, speaker_resized, combined)
-            video_fragments.append(combined)
-            cycle_temp_files.append(combined)
+            combined_renditions = {
+                name: os.path.join(temp_folder, f'combined_{i:02d}_{name}.mp4') for name in renditions
+            }
+            thumbnails_pattern = None
+            if thumbnails_dir:
+                frames_dir = os.path.join(temp_folder, f'thumbs_{i:02d}')
+                os.makedirs(frames_dir)
+                thumbnails_pattern = os.path.join(frames_dir, '%04d.jpg')
+            combine_videos(slide_vid, speaker_resized, combined, renditions=combined_renditions,
+                           profile=encoding_profile, video_bitrate=video_bitrate,
+                           thumbnails_pattern=thumbnails_pattern, duration=duration)
+            video_fragments.append(store_fragment(cache_keys[NATIVE_RENDITION], combined))
+            for name, path in combined_renditions.items():
+                rendition_fragments[name].append(store_fragment(cache_keys[name], path))
+            if thumbnails_dir:
+                strip_path = os.path.join(temp_folder, f'thumbs_{i:02d}.jpg')
+                thumbnails_to_strip(frames_dir, duration, strip_path)
+                thumbnail_strips.append((offset, duration, store_fragment(thumbnails_key, strip_path, ext='.jpg')))
+            offset += duration
 
         logging.info("All fragments processed. Concatenating into final video.")
-        concat_videos(video_fragments, output_path)
+        concat_list = os.path.join(temp_folder, 'inputs.txt')
+        chapters_path = os.path.join(temp_folder, 'chapters.txt')
+        write_chapters_metadata(chapters, chapters_path)
+        concat_videos(video_fragments, output_path, list_path=concat_list, metadata_path=chapters_path,
+                      duration=offset)
+        for name, path in renditions.items():
+            logging.info(f"Concatenating {name} rendition into {path}")
+            concat_videos(rendition_fragments[name], path, list_path=concat_list, metadata_path=chapters_path,
+                          duration=offset)
+        if hls_dir:
+            durations = [slide['end'] - slide['start'] for slide in slides_data_list]
+            concat_videos_hls(video_fragments, hls_dir, hls_segment_times(durations), duration=offset)
+        if thumbnails_dir:
+            os.makedirs(thumbnails_dir, exist_ok=True)
+            build_thumbnail_sprite(thumbnail_strips, os.path.join(thumbnails_dir, SPRITE_FILENAME),
+                                   os.path.join(thumbnails_dir, THUMBNAILS_VTT_FILENAME))
 
         logging.info(f"Successfully created final video at: {output_path}")
+        prune_fragment_cache()
         # ИСПРАВЛЕНО: Функция больше ничего не возвращает при успехе.
         # Ее успешное завершение само по себе является результатом.
 
     finally:
         # Очищаем все промежуточные файлы, созданные в этом процессе
-        inputs_txt_path = 'inputs.txt'
-        if os.path.exists(inputs_txt_path):
-             cycle_temp_files.append(inputs_txt_path)
-
-        for f_path in cycle_temp_files:
-            if os.path.exists(f_path):
-                try:
-                    os.remove(f_path)
-                except OSError as e:
-                    logging.warning(f"Could not remove temp file {f_path}: {e}")
\ No newline at end of file
+        shutil.rmtree(temp_folder, ignore_errors=True)
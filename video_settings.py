@@ -0,0 +1,65 @@
+# Настройки выходного видео, которые нужны и веб-сервису (проверка параметров формы), и воркеру:
+# варианты качества, параметры HLS и профили кодирования. Модуль не импортирует ничего тяжелого,
+# поэтому веб-сервис может его загружать, не подтягивая video_processor.
+
+# Доступные варианты качества итогового видео: имя -> высота кадра.
+# Основное видео всегда собирается в 1920x1080, остальные масштабируются из него.
+RENDITIONS = {
+    '1080p': 1080,
+    '720p': 720,
+    '480p': 480,
+}
+NATIVE_RENDITION = '1080p'
+
+# Параметры HLS-выдачи: целевая длительность сегмента и имя плейлиста.
+HLS_SEGMENT_DURATION = 6
+HLS_PLAYLIST_NAME = 'playlist.m3u8'
+
+# Профили кодирования итогового видео (этап склейки слайда и спикера).
+# 'default' — настройки libx264 по умолчанию. 'screen' и 'screen_small' рассчитаны на кадр,
+# большая часть которого — статичный слайд: aq-mode=3 и ослабленный deblock сохраняют четкость
+# текста, а ключевые кадры ставятся на каждой смене слайда (каждый фрагмент начинается с ключевого кадра)
+# и не реже чем раз в keyframe_interval секунд внутри длинного слайда.
+ENCODING_PROFILES = {
+    'default': {},
+    'screen': {
+        'preset': 'slow',
+        'crf': 26,
+        'x264_params': 'aq-mode=3:deblock=-1,-1',
+        'keyframe_interval': HLS_SEGMENT_DURATION,
+        'audio_bitrate': 96,
+    },
+    'screen_small': {
+        'preset': 'slower',
+        'crf': 30,
+        'x264_params': 'aq-mode=3:deblock=-1,-1',
+        'keyframe_interval': HLS_SEGMENT_DURATION,
+        'audio_bitrate': 64,
+    },
+}
+DEFAULT_ENCODING_PROFILE = 'default'
+# Битрейт аудио AAC по умолчанию (кбит/с) и минимальный битрейт видео при расчете по размеру файла
+DEFAULT_AUDIO_BITRATE = 128
+MIN_VIDEO_BITRATE = 100
+
+
+def validate_encoding_profile(profile):
+    """Возвращает имя профиля кодирования (по умолчанию 'default'). При неизвестном имени выбрасывает ValueError."""
+    profile = profile or DEFAULT_ENCODING_PROFILE
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Неизвестный профиль кодирования: {profile}. Доступны: {', '.join(ENCODING_PROFILES)}")
+    return profile
+
+
+def validate_renditions(renditions):
+    """
+    Проверяет список запрошенных вариантов качества и возвращает его без дублей и без основного (1080p).
+    При неизвестном имени выбрасывает ValueError.
+    """
+    result = []
+    for name in renditions or []:
+        if name not in RENDITIONS:
+            raise ValueError(f"Неизвестный вариант качества: {name}. Доступны: {', '.join(RENDITIONS)}")
+        if name != NATIVE_RENDITION and name not in result:
+            result.append(name)
+    return result